@@ -54,4 +54,21 @@ CREATE TABLE IF NOT EXISTS grades (
     FOREIGN KEY (student_id) REFERENCES students(id),
     FOREIGN KEY (subject_id) REFERENCES subjects(id),
     PRIMARY KEY (student_id, subject_id)
+);
+
+-- speed up lookups by parent and back the programs/subjects upserts
+CREATE INDEX IF NOT EXISTS idx_departments_inst ON departments(institute_id);
+CREATE UNIQUE INDEX IF NOT EXISTS programs_dep_name ON programs(department_id, name);
+CREATE UNIQUE INDEX IF NOT EXISTS uq_subjects_prog_name ON subjects(program_id, name);
+
+-- covers only subjects still missing semester or evaluation method (data correction pass)
+CREATE INDEX IF NOT EXISTS subjects_needs_fix ON subjects(id) WHERE semester = 0 OR eval_method = '';
+
+-- lets the scholarship pass load grades per group
+CREATE INDEX IF NOT EXISTS students_group ON students(group_id);
+
+-- programs whose subject pages were all scraped, the subjects pass resumes with the rest
+CREATE TABLE IF NOT EXISTS scraped_programs (
+    program_id INTEGER PRIMARY KEY,
+    FOREIGN KEY (program_id) REFERENCES programs(id)
 );
\ No newline at end of file
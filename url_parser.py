@@ -22,10 +22,11 @@ Key Features:
     - Data normalization and cleaning
     - Smart semester/evaluation method inference
     - Progress resumption capability
+    - On-disk cache of fetched pages for re-runs
     - Practice matching using fuzzy string matching
 Dependencies:
     - requests, requests_ntlm: For HTTP requests and authentication
-    - beautifulsoup4: For HTML/XML parsing
+    - lxml: For HTML/XML parsing
     - sqlite3: For database operations  
     - multiprocessing: For parallel processing
     - fuzzywuzzy: For fuzzy string matching
@@ -33,19 +34,29 @@ Dependencies:
 Author: RoCooEngi
 """
 import sqlite3
+import functools
+import os
+import hashlib
+import io
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from requests_ntlm import HttpNtlmAuth
-from bs4 import BeautifulSoup
-from urllib.parse import urlparse
+from lxml import html as lh, etree
+from urllib.parse import urlparse, urljoin
 import re
 import time
 import random
 from russian_names import RussianNames
 import multiprocessing as mp
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import signal
 from fuzzywuzzy import process, fuzz
 from pprint import pprint
 from datetime import datetime
+from itertools import accumulate, repeat
+from collections import defaultdict
 
 # Program configuration dictionary
 CONFIG = {
@@ -71,12 +82,62 @@ CONFIG = {
     'SCHOLARSHIP_ACADEMIC': (11_500, 0.3),
     'EXAM_PROBABILITY': (0.25, 0.4, 0.25, 0.1), # Probabilities for grades 5,4,3,2
     'PASS_PROBABILITY': (0.75, 0.25),           # Probabilities for pass/fail
+    'INTERACTIVE_PAUSES': False,                # Pause between institute/department pages (off for batch runs)
+    'FETCH_WORKERS': 8,                         # Concurrent page requests of each fetch thread pool
+    'REQUEST_TIMEOUT': (10, 60),                # Connect/read timeout of a portal request in seconds
+    'HTTP_CACHE_DIR': 'http_cache',             # Saved portal pages reused by re-runs (None disables the cache)
+    'HTTP_CACHE_TTL': 24 * 60 * 60,             # Seconds a saved page is reused before it is fetched again
 }
 
-session_counter = 0 # Global session counter for retrying requests
+SCHEMA_VERSION = 2  # Version of tables_init.sql, bump it whenever the script changes
+PORTAL_ORIGIN = '{0.scheme}://{0.netloc}'.format(urlparse(CONFIG['MAIN_URL']))  # Scheme and host of the portal
+
+# Compiled once at import: link patterns of the three portal levels and text parsing helpers
+FACULT_PAT = re.compile(r"Facult/[A-Z]+(?=/|$)")                         # Institute pages
+DEP_PAT = re.compile(r"/Facult/[A-Z]+/[A-Z]+(?:/default\.aspx)?$")       # Department pages
+PROG_PAT = re.compile(r"/\d{2}\.\d{2}\.\d{2}[^/]*(?:/default\.aspx)?$")  # Program pages
+LABPR_RE = re.compile(r'^\s*(\d+)\s*/\s*(\d+)\s*$')                      # "labs / practices" counts
+SEM_RE = re.compile(r"\d+")                                              # Semester number in a "Семестр" cell
+SEM_NAME_RE = re.compile(r'\b(\d{1,2})(?:-й|-ой|-го|-му|-м|-й\s+|-го\s+)?\s*семестр', re.IGNORECASE)  # "N семестр" in a subject name
+STUDY_MODE_RE = re.compile(r"\b(очная|заочная|з/о|о/о|201\d|20\d{2})\b", re.IGNORECASE)             # Mode/year noise in program names
+NAME_SEP_RE = re.compile(r'[\s,;/]+')                                    # Word separators in program names
+NON_ALNUM_RE = re.compile(r"[^A-Za-zА-Яа-я0-9]")                         # Punctuation stripped from name words
+ALNUM_RE = re.compile(r'[A-Za-zА-Яа-я0-9]')                              # Any letter or digit
+ABBR_CHAR_RE = re.compile(r'[A-Za-zА-Я0-9]')                             # Characters kept from a parenthesized abbreviation
+PARENS_RE = re.compile(r"\(([^\)]+)\)")                                  # Parenthesized part of a program name
+QUOTED_RE = re.compile(r'["\'\u00AB\u00BB](.+?)["\'\u00AB\u00BB]')       # Quoted title inside a program name
+DASH_RUN_RE = re.compile(r'-{2,}')                                       # Repeated dashes
+DASH_SPLIT_RE = re.compile(r'[-–—]')                                     # Hyphen and dashes inside a word
+COURSE_CODE_RE = re.compile(r'[бвмс]\d+')                                # Course codes like "б1" skipped by make_abbr
+LETTER_RE = re.compile(r'[A-Za-zА-Яа-я]')                                # Any letter
+WORD_RE = re.compile(r'[A-Za-zА-Яа-я]+')                                 # Words of letters
+CAPS_RE = re.compile(r'[A-ZА-Я]')                                        # Uppercase letters
+CAPS_DIGITS_RE = re.compile(r'[A-ZА-Я0-9]')                              # Uppercase letters and digits
+
+# Header keywords of the normalized fields, in order of preference
+FIELD_KEYWORDS = {
+    "Семестр": ("семестр",),
+    "Количество лекций": ("количество лек",),
+    "Кол-во лаб/практ": ("лаборат", "практическ"),
+    "Отчетность": ("отчетност", "форма"),
+    "Преподаватель-лектор": ("лектор",),
+    "Преподаватели-ассистенты": ("ассистент",),
+}
+HEADER_KEYWORDS = tuple(sub for keywords in FIELD_KEYWORDS.values() for sub in keywords)
+
+# Compiled once at import: XPath queries run on every parsed page
+LINKS_XP = etree.XPath("//a[@href]")                                                    # Links of a page
+WEBQUERY_XP = etree.XPath("//@*[name()='o:webquerysourcehref']")                        # XML export links of list views
+TEXT_XP = etree.XPath(".//text()[not(ancestor::script or ancestor::style)]")           # Visible text pieces of an element
+LISTVIEW_TABLES_XP = etree.XPath(
+    "//table[contains(concat(' ', normalize-space(@class), ' '), ' ms-listviewtable ')]")  # SharePoint list tables
+HEADER_XP = etree.XPath(".//tr[contains(@class, 'ms-viewheader') or contains(@class, 'ms-headerrow')]"
+                        " | .//*[contains(@class, 'ms-vh')]")                          # Table header rows and cells, in one scan
 
 stop_flag = mp.Value('b', False)  # Shared boolean flag for stopping multiprocessing
 
+thread_data = threading.local()  # Per-thread HTTP sessions of the subject fetch pool
+
 def init_worker(flag):
     '''Initialize each worker with access to shared stop flag.'''
     global stop_flag
@@ -89,59 +150,234 @@ def init_worker(flag):
     # and installs a SIGINT handler that sets the flag. This allows the
     # main process to request a graceful shutdown of workers.
 
+@functools.lru_cache(maxsize=None)
+def ntlm_auth(USERNAME: str, PASSWORD: str):
+    '''Returns the shared NTLM auth handler for a pair of credentials.'''
+    return HttpNtlmAuth(USERNAME, PASSWORD)
+
+# The handshake state of `HttpNtlmAuth` lives in the request being
+# retried, not in the handler, so one handler per account is shared by
+# every session (and fetch thread) using those credentials.
+
 def create_session(USERNAME=CONFIG['USERNAME'], PASSWORD=CONFIG['PASSWORD']):
     '''Creates and returns an NTLM-authenticated session.'''
     session = requests.Session()
-    session.auth = HttpNtlmAuth(USERNAME, PASSWORD)
+    session.auth = ntlm_auth(USERNAME, PASSWORD)
+    retries = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False)
+    session.mount('https://', HTTPAdapter(pool_connections=20, pool_maxsize=20, max_retries=retries))
     return session
 
 # `create_session` centralizes NTLM authentication creation so callers
 # can get a ready-to-use `requests.Session` with credentials attached.
+# The session is meant to live for the whole run: its keep-alive pool
+# reuses connections that already passed the NTLM handshake, and the
+# adapter retries transient server errors with backoff.
+
+def connect_db(db_name=CONFIG['DB_NAME']):
+    '''Opens an SQLite connection tuned for bulk inserts.'''
+    connection = sqlite3.connect(db_name, cached_statements=256)
+    connection.executescript('''
+        PRAGMA journal_mode = WAL;
+        PRAGMA synchronous = NORMAL;
+        PRAGMA temp_store = MEMORY;
+        PRAGMA cache_size = -65536;
+        PRAGMA mmap_size = 268435456;
+    ''')
+    return connection
+
+# WAL journaling with `synchronous = NORMAL` turns each commit into an
+# append to the -wal file instead of a full fsync of the database, which
+# is what dominated insert time. The page cache (64 MiB) and memory map
+# (256 MiB) keep the grades table hot during the generator passes.
+
+def existing_tables(cursor: sqlite3.Cursor):
+    '''Returns the names of the tables already present in the database.'''
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    return {row[0] for row in cursor.fetchall()}
+
+def merge_duplicate_programs(cursor: sqlite3.Cursor):
+    '''Collapses programs repeated within a department onto the newest row.'''
+    tables = existing_tables(cursor)
+    if 'programs' not in tables:
+        return
+    cursor.execute('''CREATE TEMP TABLE program_dups AS
+                      SELECT p.id AS old_id, k.keep_id
+                      FROM programs p
+                      JOIN (SELECT department_id, name, MAX(id) AS keep_id FROM programs
+                            GROUP BY department_id, name HAVING COUNT(*) > 1) k
+                        ON p.department_id = k.department_id AND p.name = k.name
+                      WHERE p.id != k.keep_id''')
+    # subjects and groups follow their program to the kept row
+    for child in ('subjects', 'groups'):
+        if child in tables:
+            cursor.execute(f'''UPDATE {child} SET program_id = (SELECT keep_id FROM program_dups WHERE old_id = program_id)
+                               WHERE program_id IN (SELECT old_id FROM program_dups)''')
+    cursor.execute('DELETE FROM programs WHERE id IN (SELECT old_id FROM program_dups)')
+    print(f'{cursor.rowcount} duplicate programs merged')
+    cursor.execute('DROP TABLE program_dups')
+
+# Databases written before the `(department_id, name)` unique index could
+# hold the same program twice (`INSERT OR REPLACE` had no conflict key on
+# programs), which would make creating the index fail. Runs once, before
+# tables_init.sql, when upgrading from schema version 1.
+
+def merge_duplicate_subjects(cursor: sqlite3.Cursor):
+    '''Collapses subjects repeated within a program onto the newest row.'''
+    tables = existing_tables(cursor)
+    if 'subjects' not in tables:
+        return
+    cursor.execute('''CREATE TEMP TABLE subject_dups AS
+                      SELECT s.id AS old_id, k.keep_id
+                      FROM subjects s
+                      JOIN (SELECT program_id, name, MAX(id) AS keep_id FROM subjects
+                            GROUP BY program_id, name HAVING COUNT(*) > 1) k
+                        ON s.program_id = k.program_id AND s.name = k.name
+                      WHERE s.id != k.keep_id''')
+    if 'grades' in tables:
+        # grades follow their subject unless the student already has one for the kept row
+        cursor.execute('''UPDATE OR IGNORE grades SET subject_id = (SELECT keep_id FROM subject_dups WHERE old_id = subject_id)
+                          WHERE subject_id IN (SELECT old_id FROM subject_dups)''')
+        cursor.execute('DELETE FROM grades WHERE subject_id IN (SELECT old_id FROM subject_dups)')
+    cursor.execute('DELETE FROM subjects WHERE id IN (SELECT old_id FROM subject_dups)')
+    print(f'{cursor.rowcount} duplicate subjects merged')
+    cursor.execute('DROP TABLE subject_dups')
+
+# Before the `(program_id, name)` unique index, a re-scraped subject whose
+# semester had changed was inserted again instead of updated. Runs once,
+# after the programs merge (which can produce more such pairs) and before
+# tables_init.sql, when upgrading from schema version 1.
+
+def backfill_scraped_programs(cursor: sqlite3.Cursor):
+    '''Marks programs finished by runs made before `scraped_programs` existed.'''
+    cursor.execute('SELECT program_id FROM subjects ORDER BY id')
+    program_ids = [row[0] for row in cursor.fetchall()]
+    # a program followed by anything but the next program id (or by nothing)
+    # may have been cut short before a later half or run took over
+    unfinished = {prog_id for prog_id, next_id in zip(program_ids, program_ids[1:])
+                  if next_id != prog_id and next_id != prog_id + 1}
+    if program_ids:
+        unfinished.add(program_ids[-1])
+    cursor.executemany('INSERT OR IGNORE INTO scraped_programs (program_id) VALUES (?)',
+                       [(prog_id,) for prog_id in set(program_ids) - unfinished])
+
+# Runs once, when a database is upgraded from schema version 1. Older
+# runs saved subjects program by program in id order, one half after
+# the other and resuming at the last saved program, so an interrupted
+# half shows up as a gap in the saved program ids. The program before
+# every gap and the newest one are left unmarked and get scraped again;
+# the subject upsert keeps that from duplicating rows. Programs that
+# really have no subjects also cause a gap, which only costs a re-scrape.
+
+def cache_path(url: str):
+    '''Returns the file a portal page is saved to in the HTTP cache.'''
+    return os.path.join(CONFIG['HTTP_CACHE_DIR'], hashlib.sha1(url.encode()).hexdigest() + '.html')
+
+def cached_response(url: str):
+    '''Returns the saved response for the URL if it is still fresh, otherwise None.'''
+    if not CONFIG['HTTP_CACHE_DIR']:
+        return None
+    path = cache_path(url)
+    try:
+        if time.time() - os.path.getmtime(path) > CONFIG['HTTP_CACHE_TTL']:
+            return None
+        with open(path, 'rb') as f:
+            content_type, _, content = f.read().partition(b'\n')
+    except OSError:
+        return None
+    response = requests.Response()
+    response.status_code = 200
+    response.url = url
+    response.headers['Content-Type'] = content_type.decode('latin-1')
+    response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+    response._content = content
+    return response
 
-def url_parser(session: requests.Session, url: str, USERNAME=CONFIG['USERNAME'], PASSWORD=CONFIG['PASSWORD'], SSL_CERTIFICATE=CONFIG['SSL_CERTIFICATE']):
+def save_response(url: str, response: requests.Response):
+    '''Saves a successful response to the HTTP cache.'''
+    if not CONFIG['HTTP_CACHE_DIR']:
+        return
+    os.makedirs(CONFIG['HTTP_CACHE_DIR'], exist_ok=True)
+    path = cache_path(url)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(response.headers.get('Content-Type', '').encode('latin-1') + b'\n' + response.content)
+    os.replace(tmp_path, path)
+
+# Re-runs mostly walk pages that did not change since the previous run,
+# so successful responses are saved under `HTTP_CACHE_DIR` (one file per
+# URL: the Content-Type line followed by the body) and reused for
+# `HTTP_CACHE_TTL` seconds. Files are written under a temporary name and
+# renamed, so concurrent workers never read a half-written page. Delete
+# the directory to force a full re-fetch.
+
+def url_parser(session: requests.Session, url: str, SSL_CERTIFICATE=CONFIG['SSL_CERTIFICATE']):
     '''Parses a URL and handles authentication errors and retries.'''
-    global session_counter
-    response = session.get(url, verify=SSL_CERTIFICATE)
-    status = response.status_code
-    if status != 200:
+    response = cached_response(url)
+    if response is not None:
+        print(f'Page {url} status: cached')
+        return response
+    for attempt in range(5):
+        try:
+            response = session.get(url, verify=SSL_CERTIFICATE, timeout=CONFIG['REQUEST_TIMEOUT'])
+        except requests.RequestException as e:
+            print(f'Page {url} request failed: {e}')
+            return None
+        status = response.status_code
+        if status != 401:
+            break
         print(f'Page {url} status: {status} - denied.')
-        if status == 401:
+        if attempt < 4:
             print('Trying to reconnect...')
-            session_counter += 1
-            if session_counter > 5:
-                session_counter = 0
-                return None
-            session = create_session(USERNAME, PASSWORD)
-            response = url_parser(session, url)
+            time.sleep(2 ** attempt)  # back off 1, 2, 4, 8 s so a flapping domain controller can recover
+    else:
+        return None
+    if status != 200:
+        print(f'Page {url} status: {status} - denied.')
+    else:
+        save_response(url, response)
     print(f'Page {url} status: {status} - successful')
     return response
 
 # `url_parser` is a small wrapper around `session.get` that attempts to
-# recover from HTTP 401 (unauthorized) by recreating the session and
-# retrying. It also uses `SSL_CERTIFICATE` when verifying TLS, which is
-# required for the university portal's custom CA bundle.
-
-def get_links(response: requests.Response):
-    '''Extracts and returns all links from the HTML response as a dictionary.'''
-    soup = BeautifulSoup(response.text, 'html.parser')
-    links = {}
-    for a in soup.find_all('a', href=True):
-        link = a['href']
-        if not link.startswith("http"):
-            link = requests.compat.urljoin(CONFIG['MAIN_URL'], link)
-        links[a.get_text(strip=True)] = link
-    return links
-
-# `get_links` returns a mapping of link text -> absolute URL. It uses
-# `MAIN_URL` as the base for resolving relative links. Link text is used
-# as the dictionary key because the portal's navigation relies on
-# descriptive anchor text.
+# recover from HTTP 401 (unauthorized) by retrying with exponential
+# backoff, which redoes the NTLM handshake, giving up after five
+# attempts. The session, its cached auth handler and its connection pool
+# are kept. A page that times out or whose connection fails after the
+# adapter's retries is reported and skipped like a denied one instead of
+# aborting the crawl. It also uses `SSL_CERTIFICATE` when verifying TLS,
+# which is required for the university portal's custom CA bundle.
+
+@functools.lru_cache(maxsize=4096)
+def absolute_url(link: str):
+    '''Resolves a portal link against the main portal URL.'''
+    if link.startswith("http"):
+        return link
+    # site-rooted links only need the portal origin in front (dot segments still go through urljoin)
+    if link.startswith("/") and not link.startswith("//") and "/." not in link:
+        return PORTAL_ORIGIN + link
+    return urljoin(CONFIG['MAIN_URL'], link)
+
+# Navigation menus repeat on every portal page, so most links are
+# resolved from the cache. Site-rooted links ("/Facult/...") that miss
+# it are joined to the portal origin by concatenation, which gives the
+# same result as `urljoin` without parsing both URLs.
+
+def get_links(response: requests.Response, pattern: re.Pattern = None):
+    '''Yields (link text, absolute URL) pairs from the HTML response, optionally only URLs matching pattern.'''
+    for a in LINKS_XP(html_tree(response)):
+        link = absolute_url(a.get('href'))
+        if pattern is None or pattern.search(link):
+            yield node_text(a, sep=""), link
+
+# `get_links` yields link text -> absolute URL pairs. It uses `MAIN_URL`
+# as the base for resolving relative links. Link text is used as the key
+# when callers build a dict, because the portal's navigation relies on
+# descriptive anchor text. Filtering by the level pattern happens during
+# extraction, e.g. `dict(get_links(response, DEP_PAT))`.
 
 def xml_extractor(response: requests.Response):
     '''Finds and returns the XML file URL from the HTML response.'''
-    soup = BeautifulSoup(response.text, 'html.parser')
-    for a in soup.find_all(attrs={'o:webquerysourcehref': True}):
-        data = a['o:webquerysourcehref']
+    for data in WEBQUERY_XP(html_tree(response)):
         if 'XMLDATA' in data:
             return data
 
@@ -151,42 +387,53 @@ def xml_extractor(response: requests.Response):
 # containing 'XMLDATA'.
 
 def xml_parser(response: requests.Response, key: str):
-    '''Parses XML response and extracts values by key.'''
-    soup = BeautifulSoup(response.text, 'lxml-xml')
-    return [row.get(key) for row in soup.find_all('z:row') if row.get(key)]
+    '''Parses XML response and yields values by key.'''
+    for _, row in etree.iterparse(io.BytesIO(response.content), events=('end',), tag='{*}row', recover=True):
+        value = row.get(key)
+        if value:
+            yield value
+        # drop rows already read so the tree never holds the whole export
+        row.clear()
+        while row.getprevious() is not None:
+            del row.getparent()[0]
 
 # `xml_parser` expects SharePoint-like XML where each record is a
 # `z:row` element and values are stored as attributes. Caller provides
-# the attribute `key` to extract (e.g. subject name attribute).
+# the attribute `key` to extract (e.g. subject name attribute). Rows are
+# streamed with `iterparse` and released once read. Like the
+# BeautifulSoup parser it replaced, it recovers from truncated exports
+# and yields whatever rows could be read.
         
-def pattern_links(links: dict, pattern: re.Pattern):
-    '''Filters links dictionary by regex pattern.'''
-    return {name: link for name, link in links.items() if re.search(pattern, link)}
-
-# Utility to filter the `get_links` result using a compiled regex. This
-# keeps higher-level code concise when selecting institute/department
-# and program links.
-
+@functools.lru_cache(maxsize=8192)
 def clean_text(t):
     '''Cleans and normalizes text by removing extra spaces.'''
-    return re.sub(r"\s+", " ", t.strip()) if t else ""
+    return " ".join(t.split()) if t else ""
 
 # Normalizes whitespace and guards against `None` values. Used widely
-# to sanitize scraped table cell contents.
+# to sanitize scraped table cell contents. `str.split()` splits on the
+# same Unicode whitespace as `\s+` but runs in C without the regex
+# engine, roughly three times faster per cell. Header names, blank cells
+# and common values ("Экзамен", "3") repeat across every table, so
+# results are memoized.
 
 def parse_subject(session: requests.Session, url: str):
     '''Parses subject page and extracts semester information.'''
-    response = session.get(url, verify=CONFIG['SSL_CERTIFICATE'])
-    soup = BeautifulSoup(response.text, "html.parser")
+    response = session.get(url, verify=CONFIG['SSL_CERTIFICATE'], timeout=CONFIG['REQUEST_TIMEOUT'])
+    tree = html_tree(response)
     result = {}
 
+    def cell_text(node):
+        return clean_text("".join(TEXT_XP(node)))
+
     # Find table with subject parameters
-    table = soup.find("table", class_="ms-listviewtable")
-    if table:
-        headers = [clean_text(th.get_text()) for th in table.find_all("th")]
-        data_row = table.find("tr", class_="ms-itmhover") or table.find("tr", class_="")
-        if data_row:
-            values = [clean_text(td.get_text()) for td in data_row.find_all("td")]
+    tables = LISTVIEW_TABLES_XP(tree)
+    if tables:
+        table = tables[0]
+        headers = [cell_text(th) for th in table.iterdescendants("th")]
+        data_rows = (table.xpath(".//tr[contains(concat(' ', normalize-space(@class), ' '), ' ms-itmhover ')]")
+                     or table.xpath(".//tr[@class='']"))
+        if data_rows:
+            values = [cell_text(td) for td in data_rows[0].iterdescendants("td")]
             if len(headers) == len(values):
                 row_map = dict(zip(headers, values))
                 result.update(row_map)
@@ -211,66 +458,117 @@ def log_request_error(table: str):
 # Small helper to keep messaging consistent when DB_OPERATIONS flags
 # are turned off.
 
+def html_parser(encoding: str = None):
+    '''Returns the calling thread's HTML parser for the given encoding, creating it on first use.'''
+    parsers = getattr(thread_data, 'html_parsers', None)
+    if parsers is None:
+        parsers = thread_data.html_parsers = {}
+    parser = parsers.get(encoding)
+    if parser is None:
+        parser = parsers[encoding] = lh.HTMLParser(encoding=encoding)
+    return parser
+
+# lxml locks a parser while it is in use, so a parser shared between the
+# fetch threads would serialize them; each thread keeps its own instead.
+
+def html_tree(response: requests.Response):
+    '''Parses an HTML response body into an lxml element tree.'''
+    # trust the charset only if the server sent one, otherwise let lxml read the page's <meta>
+    encoding = response.encoding if 'charset=' in response.headers.get('Content-Type', '').lower() else None
+    return lh.document_fromstring(response.content, parser=html_parser(encoding))
+
+# Bytes are parsed directly: lxml refuses `str` input that still carries
+# an XML encoding declaration, which SharePoint pages may have.
+
+def node_text(node, sep=" "):
+    '''Returns the text of an element as stripped pieces joined by sep.'''
+    return sep.join(t.strip() for t in TEXT_XP(node) if t.strip())
+
+# lxml counterpart of BeautifulSoup's `get_text(sep, strip=True)`; like
+# BeautifulSoup it leaves out comments and script/style contents.
+
 def is_icon_td(td):
     '''Checks if a table cell contains only an icon (image or link without text).'''
-    txt = clean_text(td.get_text(" ", strip=True))
-    if txt:
+    # links inside a cell without text have no text either, so they need no separate check
+    # stop at the first visible text instead of joining the whole cell
+    if any(t.strip() for t in TEXT_XP(td)):
         return False
-    imgs = td.find_all("img")
-    links = td.find_all("a")
-    if imgs and not any(clean_text(a.get_text()) for a in links):
-        return True
-    return False
+    return next(td.iter("img"), None) is not None
 
 # The program's HTML tables sometimes include leading icon cells that do
 # not correspond to data columns. `is_icon_td` detects such cells so the
 # parser can skip them and align values with headers.
 
-def parse_program_page(session: requests.Session, url: str):
-    '''Parses a program page and returns normalized data table.'''
+@functools.lru_cache(maxsize=128)
+def key_for_fields(headers: tuple):
+    '''Maps normalized field names to the table headers they are read from.'''
+    # one pass over the headers: first header containing each keyword
+    first_with = {}
+    for k in headers:
+        low = k.lower()
+        for sub in HEADER_KEYWORDS:
+            if sub in low and sub not in first_with:
+                first_with[sub] = k
+    key_for = {}
+    for field, keywords in FIELD_KEYWORDS.items():
+        k = next((first_with[sub] for sub in keywords if sub in first_with), None)
+        if k:
+            key_for[field] = k
+    return key_for
+
+# Header names vary between programs ("Форма отчетности", "Отчетность",
+# ...), so each normalized field takes the first header containing one
+# of its keywords, trying the keywords in order. Subject pages share a
+# handful of SharePoint layouts, so the mapping is cached per header
+# tuple and the keyword scans run once per layout instead of once per
+# page.
+
+def parse_program_page(session: requests.Session, url: str, want: tuple = None):
+    '''Parses a program page and returns normalized data table (or only the `want` fields).'''
     response = url_parser(session, url)
     if not response:
         return None
-    soup = BeautifulSoup(response.text, "html.parser")
-    tables = soup.find_all("table", class_="ms-listviewtable")
+    tree = html_tree(response)
+    tables = LISTVIEW_TABLES_XP(tree)
     all_parsed = []
 
     for table in tables:
         # find headers
-        header_tr = table.find("tr", class_=re.compile(r"ms-viewheadertr|ms-headerrow|ms-viewheader"))
+        header_tr = None
         headers = []
-        for h in table.find_all(class_=re.compile(r"ms-vh")):
-            t = clean_text(h.get_text(" ", strip=True))
+        for h in HEADER_XP(table):
+            cls = h.get('class', '')
+            if header_tr is None and h.tag == 'tr' and ('ms-viewheader' in cls or 'ms-headerrow' in cls):
+                header_tr = h
+            if 'ms-vh' not in cls:
+                continue
+            t = clean_text(node_text(h))
             if t and t not in headers:
                 headers.append(t)
-        if not headers and header_tr:
-            headers = [clean_text(x.get_text(" ", strip=True)) for x in header_tr.find_all(['th', 'td']) if clean_text(x.get_text(" ", strip=True))]
+        if not headers and header_tr is not None:
+            headers = [clean_text(node_text(x)) for x in header_tr.iterdescendants('th', 'td') if clean_text(node_text(x))]
 
         # Collect rows
         rows = []
-        if header_tr:
-            r = header_tr.find_next_sibling("tr")
-            while r:
-                tds = r.find_all("td")
+        if header_tr is not None:
+            # rows are only kept when there are headers to zip them with
+            for r in (header_tr.itersiblings('tr') if headers else ()):
+                tds = list(r.iterdescendants('td'))
                 if tds:
-                    vals = [clean_text(td.get_text(" ", strip=True)) for td in tds]
-                    tds_copy = list(tds)
-                    while headers and len(vals) > len(headers) and tds_copy and is_icon_td(tds_copy[0]):
-                        tds_copy.pop(0)
-                        vals.pop(0)
-                    if headers:
-                        if len(vals) < len(headers):
-                            vals += [""] * (len(headers) - len(vals))
-                        if len(vals) > len(headers):
-                            vals = vals[:len(headers)]
-                        rows.append(dict(zip(headers, vals)))
-                r = r.find_next_sibling("tr")
+                    vals = [clean_text(node_text(td)) for td in tds]
+                    # skip leading icon cells while the row is wider than the header
+                    skip = 0
+                    while len(vals) - skip > len(headers) and is_icon_td(tds[skip]):
+                        skip += 1
+                    vals = vals[skip:skip + len(headers)]
+                    vals += [""] * (len(headers) - len(vals))
+                    rows.append(dict(zip(headers, vals)))
         else:
-            for tr in table.find_all("tr"):
-                tds = tr.find_all("td")
+            for tr in table.iterdescendants('tr'):
+                tds = list(tr.iterdescendants('td'))
                 if not tds:
                     continue
-                vals = [clean_text(td.get_text(" ", strip=True)) for td in tds]
+                vals = [clean_text(node_text(td)) for td in tds]
                 gen = [f"col_{i+1}" for i in range(len(vals))]
                 rows.append(dict(zip(gen, vals)))
 
@@ -287,36 +585,29 @@ def parse_program_page(session: requests.Session, url: str):
     if selected is None and all_parsed:
         selected = all_parsed[0]
 
+    # Fast path: first non-empty value of each requested field, without normalizing rows
+    if want:
+        found = dict.fromkeys(want)
+        if selected:
+            key_for = key_for_fields(tuple(selected["headers"]))
+            for field in want:
+                k = key_for.get(field)
+                if k:
+                    found[field] = next((r[k] for r in selected["rows"] if r.get(k)), None)
+        return found
+
     # Row normalization
     norm_rows = []
     if selected:
+        # all rows of a table share its headers, so the source column of each field is looked up once
+        key_for = key_for_fields(tuple(selected["headers"]))
         for r in selected["rows"]:
             nr = dict(r)
-            def find_key(sub):
-                for k in r.keys():
-                    if sub in k.lower():
-                        return k
-                return None
-            k = find_key("семестр")
-            if k:
-                nr["Семестр"] = r[k]
-            k = find_key("количество лек")
-            if k:
-                nr["Количество лекций"] = r[k]
-            k = find_key("лаборат") or find_key("практическ")
-            if k:
-                nr["Кол-во лаб/практ"] = r[k]
-            k = find_key("отчетност") or find_key("форма")
-            if k:
-                nr["Отчетность"] = r[k]
-            k = find_key("лектор")
-            if k:
-                nr["Преподаватель-лектор"] = r[k]
-            k = find_key("ассистент")
-            if k:
-                nr["Преподаватели-ассистенты"] = r[k]
+            for field, k in key_for.items():
+                if k in r:  # rows of tables without a header row are keyed col_N
+                    nr[field] = r[k]
             v = nr.get("Кол-во лаб/практ", "")
-            m = re.match(r'^\s*(\d+)\s*/\s*(\d+)\s*$', v)
+            m = LABPR_RE.match(v)
             if m:
                 nr["Лаб"] = m.group(1)
                 nr["Практ"] = m.group(2)
@@ -332,15 +623,48 @@ def parse_program_page(session: requests.Session, url: str):
 #   "Отчетность", and split lab/practice counts in "Лаб" and "Практ".
 #
 # The function returns a list of normalized row dicts or None if the
-# page couldn't be retrieved.
+# page couldn't be retrieved. Callers that only need a few fields pass
+# `want` (e.g. `("Семестр", "Отчетность")`) and get a dict with the
+# first non-empty value of each field instead, which skips building the
+# normalized rows.
+
+def thread_session(USERNAME: str, PASSWORD: str):
+    '''Returns the calling thread's own NTLM session, creating it on first use.'''
+    session = getattr(thread_data, 'session', None)
+    if session is None:
+        session = thread_data.session = create_session(USERNAME, PASSWORD)
+    return session
+
+# NTLM authenticates a connection rather than a request, so every fetch
+# thread keeps its own session (and connection pool) instead of sharing
+# one `requests.Session` across threads.
+
+def fetch_page(url: str, USERNAME: str, PASSWORD: str):
+    '''Fetches a portal page on a fetch thread.'''
+    if CONFIG['INTERACTIVE_PAUSES']:
+        pause()
+    return url_parser(thread_session(USERNAME, PASSWORD), url)
+
+# Used by the department and program passes: pages are requested by the
+# pool while the main thread writes the previous results, so the pauses
+# overlap as well.
+
+def fetch_subject_page(sub_url: str, USERNAME: str, PASSWORD: str):
+    '''Fetches a subject page on a fetch thread and returns its semester and evaluation method.'''
+    if stop_flag.value:
+        return None
+    return parse_program_page(thread_session(USERNAME, PASSWORD), sub_url, want=("Семестр", "Отчетность"))
+
+# Runs inside the worker's thread pool. Once the stop flag is set, queued
+# pages are skipped instead of being requested.
 
 def subject_multi_process(programs: list, USERNAME:str, PASSWORD: str):
     '''Multiprocess function for parsing subjects for a list of programs.'''
     session = create_session(USERNAME, PASSWORD)
-    connection = sqlite3.connect(CONFIG['DB_NAME'])
-    cursor = connection.cursor()
+    executor = ThreadPoolExecutor(max_workers=CONFIG['FETCH_WORKERS'])
     
     progs_subjects = []
+    completed_programs = []
     
     for prog_id, prog_url in programs:
         if stop_flag.value:  # Check stop flag at the start of each iteration
@@ -350,19 +674,32 @@ def subject_multi_process(programs: list, USERNAME:str, PASSWORD: str):
         response_prog = url_parser(session, prog_url)
         if not response_prog:
             continue
-        xml_link = xml_extractor(response_prog)
-        response_xml = url_parser(session, xml_link)
-        if not response_xml:
+        try:
+            xml_link = xml_extractor(response_prog)
+            if not xml_link:
+                print(f'No subject list export found for program {prog_id}')
+                continue
+            response_xml = url_parser(session, xml_link)
+            if not response_xml:
+                continue
+            # SharePoint URL fields read "<url>, <description>"
+            subjects = {sub.strip(' /'): link.strip()
+                        for link, sub in (raw_value.split(',', 1) for raw_value in xml_parser(response_xml, 'ows__x041d__x0430__x0438__x043c__x04'))}
+        except (etree.LxmlError, ValueError) as e:
+            # empty or broken pages (e.g. an error page served with status 200), the program is retried on resume
+            print(f'Error reading the subject list of program {prog_id}: {e}')
+            continue
+        if not subjects:
+            # nothing to mark as scraped: a non-XML page parsed in recover mode has no rows either
+            print(f'No subjects for program {prog_id}')
             continue
-        subjects = xml_parser(response_xml, 'ows__x041d__x0430__x0438__x043c__x04')
-        subjects = {sub.strip(' /'): link.strip() for raw_value in subjects for link, sub in [raw_value.split(',', 1)]}
         
-        # Check existing subjects for this program
-        cursor.execute('SELECT name, semester FROM subjects WHERE program_id = ?', (prog_id,))
-        existing_subjects = {(name, semester) for name, semester in cursor.fetchall()}
+        # Request all subject pages of the program concurrently, results are consumed in order
+        pages = [executor.submit(fetch_subject_page, sub_url, USERNAME, PASSWORD) for sub_url in subjects.values()]
         
         new_subjects = []
-        for sub_name, sub_url in subjects.items():
+        failed = False  # a subject page could not be read, the program is scraped again on resume
+        for (sub_name, sub_url), page in zip(subjects.items(), pages):
             semester = 0
             eval_method = ''
             try:
@@ -370,52 +707,54 @@ def subject_multi_process(programs: list, USERNAME:str, PASSWORD: str):
                     print(f"Process {mp.current_process().name} stopping due to stop_flag")
                     break
                 # Parse subject page
-                norm_rows = parse_program_page(session, sub_url)
-                for row in norm_rows:
-                    if row.get("Семестр"):
-                        try:
-                            semester = int(row["Семестр"])
-                        except (ValueError, TypeError):
-                            print(f"Invalid semester value for {sub_name}: {row['Семестр']}")
-                            semester = 0
-                        break
-                for row in norm_rows:
-                    if row.get("Отчетность"):
-                        try:
-                            eval_method = row["Отчетность"]
-                        except (ValueError, TypeError):
-                            print(f"Invalid evaluation method value for {sub_name}: {row['Отчетность']}")
-                            eval_method = ''
-                        break
+                fields = page.result()
+                if fields is None:
+                    raise ValueError('page is unavailable')
+                if fields["Семестр"]:
+                    # cells often carry stray spaces or punctuation around the number
+                    match = SEM_RE.search(fields["Семестр"])
+                    if match:
+                        semester = int(match.group())
+                    else:
+                        print(f"Invalid semester value for {sub_name}: {fields['Семестр']}")
+                if fields["Отчетность"]:
+                    eval_method = fields["Отчетность"]
             except Exception as e:
                 print(f"Error parsing subject {sub_name} at {sub_url}: {str(e)}")
+                failed = True
                 semester = 0
                 eval_method = ''
-            # Check if subject already exists with the same semester
-            if (sub_name, semester) not in existing_subjects:
-                new_subjects.append((sub_name, semester, eval_method, sub_url, prog_id))
-                print(f'Subject: {sub_name}, Semester: {semester}, Eval method: {eval_method}, Program id: {prog_id}')
+            new_subjects.append((sub_name, semester, eval_method, sub_url, prog_id))
+            print(f'Subject: {sub_name}, Semester: {semester}, Eval method: {eval_method}, Program id: {prog_id}')
+        else:
+            # every subject page was read, the program is not revisited on resume
+            if not failed:
+                completed_programs.append(prog_id)
         
         if new_subjects:
             progs_subjects.append(new_subjects)
         else:
-            print(f'No new subjects for program {prog_id}')
+            print(f'No subjects for program {prog_id}')
         pause()
-    connection.close()
-    return progs_subjects
+    executor.shutdown(cancel_futures=True)
+    return progs_subjects, completed_programs
 
 # `subject_multi_process` is designed to run inside a worker process.
-# It creates its own authenticated session and database connection (DB
-# connections cannot be shared safely across processes). For each program
-# it fetches associated subjects via XML, parses each subject page to
-# extract semester and evaluation method, skips already-saved subjects,
-# and returns the list of new subjects to be inserted by the parent.
+# It creates its own authenticated session. For each program it fetches
+# associated subjects via XML, parses each subject page to extract
+# semester and evaluation method, and returns the scraped subjects to the
+# parent, whose upsert skips the ones already saved with that semester,
+# together with the ids of the programs it finished. Programs cut short
+# by the stop flag or with unreadable subject pages are left out, so a
+# resumed run scrapes them again and the upsert fixes their semesters.
+# Subject pages of a program are fetched by a pool of `FETCH_WORKERS`
+# threads, so the pass is bound by portal latency divided by the pool
+# size rather than the sum of all page round trips.
 
 def extract_semester_from_name(sub_name):
     '''Extracts semester number from subject name using regex.'''
     # pattern like "(Nth semester)", "(N semester)", "N semester"
-    pattern = r'\b(\d{1,2})(?:-й|-ой|-го|-му|-м|-й\s+|-го\s+)?\s*семестр'
-    match = re.search(pattern, sub_name, re.IGNORECASE)
+    match = SEM_NAME_RE.search(sub_name)
     if match:
         try:
             return int(match.group(1))
@@ -485,25 +824,25 @@ def make_abbr(text: str) -> str:
         return ''
 
     # try parentheses first (take inner quoted / parenthesized abbreviation/title)
-    match = re.search(r"\(([^\)]+)\)", text)
+    match = PARENS_RE.search(text)
     if match:
         raw = match.group(1).strip()
         # remove trailing year/mode tokens like 2018, очная, заочная, з/о etc.
-        raw = re.sub(r"\b(очная|заочная|з/о|о/о|201\d|20\d{2})\b", "", raw, flags=re.IGNORECASE).strip()
+        raw = STUDY_MODE_RE.sub("", raw).strip()
         # if parentheses content looks like an abbreviation or short code, use it
-        if 1 <= len(raw) <= 12 and re.search(r'[A-Za-zА-Яа-я0-9]', raw):
+        if 1 <= len(raw) <= 12 and ALNUM_RE.search(raw):
             # extract letters and digits, keep uppercase form
-            ab = ''.join(re.findall(r'[A-Za-zА-Я0-9]', raw))
+            ab = ''.join(ABBR_CHAR_RE.findall(raw))
             if ab:
                 return ab.upper()
 
     # handle quoted main titles ("..." or «...» or '...') preferring their initials
-    quote_match = re.search(r'["\'\u00AB\u00BB](.+?)["\'\u00AB\u00BB]', text)
+    quote_match = QUOTED_RE.search(text)
     if quote_match:
         quoted = quote_match.group(1)
         # build initials from quoted title first
-        parts_q = re.split(r'[\s,;/]+', quoted)
-        initials_q = [re.sub(r"[^A-Za-zА-Яа-я0-9]", '', w)[:1] for w in parts_q if w and len(re.sub(r"[^A-Za-zА-Яа-я0-9]", '', w))>0]
+        parts_q = NAME_SEP_RE.split(quoted)
+        initials_q = [w[:1] for w in (NON_ALNUM_RE.sub('', w) for w in parts_q if w) if w]
         if initials_q:
             return ''.join(initials_q)[:6].upper()
 
@@ -516,42 +855,42 @@ def make_abbr(text: str) -> str:
     }
 
     # normalize repeated dashes and remove stray punctuation
-    text_clean = re.sub(r'-{2,}', '-', text)
+    text_clean = DASH_RUN_RE.sub('-', text)
     # remove trailing year/mode tokens (common noise)
-    text_clean = re.sub(r"\b(очная|заочная|з/о|о/о|201\d|20\d{2})\b", "", text_clean, flags=re.IGNORECASE)
+    text_clean = STUDY_MODE_RE.sub("", text_clean)
     # split on whitespace and separators and keep hyphenated parts
-    parts = re.split(r'[\s,;/]+', text_clean)
+    parts = NAME_SEP_RE.split(text_clean)
     initials = []
     for p in parts:
         if not p:
             continue
         # split hyphenated components
-        comps = re.split(r'[-–—]', p)
+        comps = DASH_SPLIT_RE.split(p)
         for c in comps:
             # strip punctuation
-            cstr = re.sub(r"[^A-Za-zА-Яа-я0-9]", '', c)
+            cstr = NON_ALNUM_RE.sub('', c)
             if not cstr:
                 continue
             low = cstr.lower()
             # skip single-letter segments that look like course codes (like 'б1', 'б8') unless meaningful
-            if low in stopwords or re.fullmatch(r'[бвмс]\d+', low):
+            if low in stopwords or COURSE_CODE_RE.fullmatch(low):
                 continue
             # take first letter (prefer uppercase if present later we upper())
             initials.append(cstr[0])
 
     if not initials:
         # fallback: take all uppercase letters from the text
-        letters = re.findall(r'[A-ZА-Я0-9]', text)
+        letters = CAPS_DIGITS_RE.findall(text)
         return ''.join(letters).upper()
 
     # form abbreviation from initials (letters only), limit length to 6
-    initials_letters = [ch for ch in initials if re.match(r'[A-Za-zА-Яа-я]', ch)]
+    initials_letters = [ch for ch in initials if LETTER_RE.match(ch)]
     abbr = ''.join(initials_letters)[:6].upper()
 
     # If abbreviation has fewer than 2 letters, try other fallbacks
     if len(abbr) < 2:
         # 1) Try to collect initial letters from all words in the original text
-        words = re.findall(r'[A-Za-zА-Яа-я]+', text)
+        words = WORD_RE.findall(text)
         more = ''.join(w[0] for w in words if w)
         if more:
             candidate = (abbr + more).upper()
@@ -559,7 +898,7 @@ def make_abbr(text: str) -> str:
                 return candidate[:6]
 
         # 2) Fallback to extracting uppercase letters from the text (letters only)
-        up_letters = ''.join(re.findall(r'[A-ZА-Я]', text))
+        up_letters = ''.join(CAPS_RE.findall(text))
         if len(up_letters) >= 2:
             return up_letters[:6]
 
@@ -568,7 +907,7 @@ def make_abbr(text: str) -> str:
             return (abbr * 2)[:6]
 
         # 4) As a last resort, return first two alphabetic characters found anywhere
-        all_letters = ''.join(re.findall(r'[A-Za-zА-Яа-я]', text))
+        all_letters = ''.join(LETTER_RE.findall(text))
         if len(all_letters) >= 2:
             return all_letters[:6].upper()
 
@@ -579,12 +918,21 @@ def make_abbr(text: str) -> str:
 
 
 if __name__ == '__main__':
-    # Create database and tables if not exist
-    connection_db = sqlite3.connect('university.db')
+    # Create database and tables if not exist (or if tables_init.sql is newer than the database)
+    connection_db = connect_db(CONFIG['DB_NAME'])
     cursor = connection_db.cursor()
-    with open('tables_init.sql', 'r', encoding='utf-8') as file:
-        cursor.executescript(file.read())
-    connection_db.commit()
+    cursor.execute('PRAGMA user_version')
+    db_version = cursor.fetchone()[0]
+    if db_version < SCHEMA_VERSION:
+        if db_version < 2:
+            merge_duplicate_programs(cursor)
+            merge_duplicate_subjects(cursor)
+        with open('tables_init.sql', 'r', encoding='utf-8') as file:
+            cursor.executescript(file.read())
+        if db_version < 2:
+            backfill_scraped_programs(cursor)
+        cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        connection_db.commit()
 
     # Connect to the main portal if enabled
     if CONFIG['DB_OPERATIONS']['connection'] or CONFIG['DB_OPERATIONS']['all']:
@@ -595,31 +943,29 @@ if __name__ == '__main__':
         log_request_error('institutes')
     else:
         response_main = url_parser(session, CONFIG['MAIN_URL'])
-        first_level_links = get_links(response_main)
-        first_level_pattern = re.compile(r"Facult/[A-Z]+(?=/|$)")
-        links_inst = pattern_links(first_level_links, first_level_pattern)
+        links_inst = dict(get_links(response_main, FACULT_PAT))
         
         if not links_inst:
             print('Dict of institutes is empty! Check the url parser')
             exit(1)
         
-        # Get existing institutes from DB
-        cursor.execute('SELECT name, url FROM institutes')
-        existing_institutes = dict(cursor.fetchall())
-        
-        # Filter new or updated institutes
-        new_institutes = [(name, url) for name, url in links_inst.items() if name not in existing_institutes or existing_institutes[name] != url]
-        if new_institutes:
-            cursor.executemany('INSERT OR REPLACE INTO institutes (name, url) VALUES (?, ?)', new_institutes)
-            connection_db.commit()
-            print(f'{len(new_institutes)} new or updated institutes have been saved')
+        # Insert new institutes and update changed URLs, SQLite skips unchanged rows
+        cursor.executemany('''INSERT INTO institutes (name, url) VALUES (?, ?)
+                              ON CONFLICT (name) DO UPDATE SET url = excluded.url
+                              WHERE institutes.url != excluded.url''',
+                           links_inst.items())
+        saved_institutes = cursor.rowcount
+        connection_db.commit()
+        if saved_institutes:
+            print(f'{saved_institutes} new or updated institutes have been saved')
         else:
             print('No new or updated institutes to save')
-        pause()
+        if CONFIG['INTERACTIVE_PAUSES']:
+            pause()
 
 # The block above scrapes top-level institute links and updates the
-# `institutes` table. It uses `INSERT OR REPLACE` to update existing
-# records with changed URLs while preserving IDs for resumption.
+# `institutes` table. It upserts on the unique name, updating records
+# with changed URLs in place so their IDs are preserved for resumption.
 
     # Load institute page and get departments
     if not (CONFIG['DB_OPERATIONS']['departments'] or CONFIG['DB_OPERATIONS']['all']):
@@ -634,33 +980,30 @@ if __name__ == '__main__':
         cursor.execute('SELECT id, url FROM institutes WHERE id >= ? ORDER BY id', (last_institute_id,))
         institutes = cursor.fetchall()
         
-        for inst_id, inst_url in institutes:
-            response_inst = url_parser(session, inst_url)
+        # Institute pages are requested concurrently, results are saved in order
+        executor = ThreadPoolExecutor(max_workers=CONFIG['FETCH_WORKERS'])
+        responses = executor.map(fetch_page, [url for _, url in institutes], repeat(CONFIG['USERNAME']), repeat(CONFIG['PASSWORD']))
+        for (inst_id, inst_url), response_inst in zip(institutes, responses):
             if not response_inst:
                 continue
-            second_level_links = get_links(response_inst)
-            second_level_pattern = re.compile(r"/Facult/[A-Z]+/[A-Z]+(?:/default\.aspx)?$")
-            links_dep = pattern_links(second_level_links, second_level_pattern)
+            links_dep = dict(get_links(response_inst, DEP_PAT))
             if not links_dep:
                 print(f'No departments found for institute {inst_id}')
                 continue
             
-            # Check existing departments for this institute
-            cursor.execute('SELECT name, url FROM departments WHERE institute_id = ?', (inst_id,))
-            existing_departments = dict(cursor.fetchall())
-            
-            # Filter new or updated departments
-            new_departments = [(name, url, inst_id) for name, url in links_dep.items() 
-                            if name not in existing_departments or existing_departments[name] != url]
-            
-            if new_departments:
-                cursor.executemany('INSERT OR REPLACE INTO departments (name, url, institute_id) VALUES (?, ?, ?)', 
-                                new_departments)
-                connection_db.commit()
-                print(f'{len(new_departments)} new or updated departments saved for institute {inst_id}')
+            # Insert new departments and update changed ones, SQLite skips unchanged rows
+            cursor.executemany('''INSERT INTO departments (name, url, institute_id) VALUES (?, ?, ?)
+                                  ON CONFLICT (name) DO UPDATE SET url = excluded.url, institute_id = excluded.institute_id
+                                  WHERE departments.url != excluded.url OR departments.institute_id != excluded.institute_id''',
+                               [(name, url, inst_id) for name, url in links_dep.items()])
+            saved_departments = cursor.rowcount
+            connection_db.commit()
+
+            if saved_departments:
+                print(f'{saved_departments} new or updated departments saved for institute {inst_id}')
             else:
                 print(f'No new or updated departments for institute {inst_id}')
-            pause()
+        executor.shutdown()
         print('Departments data has been saved')
 
 # This section iterates institutes and collects department links,
@@ -681,50 +1024,45 @@ if __name__ == '__main__':
         cursor.execute('SELECT id, url FROM departments WHERE id >= ? ORDER BY id', (last_department_id,))
         departments = cursor.fetchall()
         
-        for dep_id, dep_url in departments:
-            response_dep = url_parser(session, dep_url)
+        # Department pages are requested concurrently, results are saved in order
+        executor = ThreadPoolExecutor(max_workers=CONFIG['FETCH_WORKERS'])
+        responses = executor.map(fetch_page, [url for _, url in departments], repeat(CONFIG['USERNAME']), repeat(CONFIG['PASSWORD']))
+        for (dep_id, dep_url), response_dep in zip(departments, responses):
             if not response_dep:
                 continue
-            third_level_links = get_links(response_dep)
-            third_level_pattern = re.compile(r"/\d{2}\.\d{2}\.\d{2}[^/]*(?:/default\.aspx)?$")
-            links_prog = pattern_links(third_level_links, third_level_pattern)
+            links_prog = dict(get_links(response_dep, PROG_PAT))
             if not links_prog:
                 print(f'No programs found for department {dep_id}')
                 continue
             
-            # Check existing programs for this department
-            cursor.execute('SELECT name, url FROM programs WHERE department_id = ?', (dep_id,))
-            existing_programs = dict(cursor.fetchall())
-            
-            # Filter new or updated programs
-            new_programs = [(name, url, dep_id) for name, url in links_prog.items() 
-                            if name not in existing_programs or existing_programs[name] != url]
-            
-            if new_programs:
-                cursor.executemany('INSERT OR REPLACE INTO programs (name, url, department_id) VALUES (?, ?, ?)', 
-                                new_programs)
-                connection_db.commit()
-                print(f'{len(new_programs)} new or updated programs saved for department {dep_id}')
+            # Insert new programs and update changed URLs, SQLite skips unchanged rows
+            cursor.executemany('''INSERT INTO programs (name, url, department_id) VALUES (?, ?, ?)
+                                  ON CONFLICT (department_id, name) DO UPDATE SET url = excluded.url
+                                  WHERE programs.url != excluded.url''',
+                               [(name, url, dep_id) for name, url in links_prog.items()])
+            saved_programs = cursor.rowcount
+            connection_db.commit()
+
+            if saved_programs:
+                print(f'{saved_programs} new or updated programs saved for department {dep_id}')
             else:
                 print(f'No new or updated programs for department {dep_id}')
-            pause()
+        executor.shutdown()
         print('Programs data has been saved')
 
 # This block finds program pages under each department and stores them
 # in the `programs` table. Pattern matching focuses on program codes
-# that follow the 'NN.NN.NN' structure used by the portal.
+# that follow the 'NN.NN.NN' structure used by the portal. Programs are
+# upserted on the `(department_id, name)` unique index, so existing rows
+# keep their IDs (subjects and groups reference them) and only changed
+# URLs are rewritten.
 
     # Load program page and get all subjects
     if not (CONFIG['DB_OPERATIONS']['subjects'] or CONFIG['DB_OPERATIONS']['all']):
         log_request_error('subjects')
     else:        
-        # Get the last processed program to resume
-        cursor.execute('SELECT program_id FROM subjects ORDER BY id DESC LIMIT 1')
-        last_program = cursor.fetchone()
-        last_program_id = last_program[0] if last_program else 0
-        
-        # Select programs starting from the last processed one
-        cursor.execute('SELECT id, url FROM programs WHERE id >= ? ORDER BY id', (last_program_id,))
+        # Resume with the programs whose subjects have not been fully scraped yet
+        cursor.execute('SELECT id, url FROM programs WHERE id NOT IN (SELECT program_id FROM scraped_programs) ORDER BY id')
         programs = cursor.fetchall()
         programs_half = [(programs[:len(programs)//2], CONFIG['USERNAME1'], CONFIG['PASSWORD1']),
                          (programs[len(programs)//2:], CONFIG['USERNAME'], CONFIG['PASSWORD'])]
@@ -750,18 +1088,28 @@ if __name__ == '__main__':
                 pool.close()
                 pool.join()
                 
-        all_results = [item for result in results for item in result]
+        all_new_subjects = [row for progs_subjects, _ in results for new_subjects in progs_subjects for row in new_subjects]
+        completed_programs = [(prog_id,) for _, done in results for prog_id in done]
         
-        # Save the results to the database
-        for new_subjects in all_results:
-            if new_subjects:
-                cursor.executemany('INSERT INTO subjects (name, semester, eval_method, url, program_id) VALUES (?, ?, ?, ?, ?)', new_subjects)
-                connection_db.commit()
-                print(f'{len(new_subjects)} new subjects saved')
+        # Save the results to the database in one batch
+        if all_new_subjects:
+            cursor.executemany('''INSERT INTO subjects (name, semester, eval_method, url, program_id) VALUES (?, ?, ?, ?, ?)
+                                  ON CONFLICT (program_id, name) DO UPDATE
+                                  SET semester = excluded.semester, eval_method = excluded.eval_method, url = excluded.url
+                                  WHERE subjects.semester != excluded.semester
+                                  -- semester 0 means the page could not be read, keep what is stored
+                                    AND excluded.semester != 0''',
+                               all_new_subjects)
+            print(f'{cursor.rowcount} new or changed subjects saved')
+        # programs are marked done in the same transaction as their subjects
+        cursor.executemany('INSERT OR IGNORE INTO scraped_programs (program_id) VALUES (?)', completed_programs)
+        connection_db.commit()
+        # refresh planner statistics so the data correction pass picks the partial index
+        cursor.execute('ANALYZE')
 
 # Subject fetching is parallelized using a Pool of workers, each with
-# its own credentials and DB connection. Results are collected and
-# inserted by the main process to avoid DB concurrency issues.
+# its own credentials. Results are collected and upserted by the main
+# process, so workers never touch the database.
 
     # Update zero data subjects' semesters and evaluation methods
     if not (CONFIG['DB_OPERATIONS']['data correction'] or CONFIG['DB_OPERATIONS']['all']):
@@ -800,14 +1148,15 @@ if __name__ == '__main__':
         MASTER_KEYWORDS = ['магистр', 'магистратура']
         SPECIALIST_KEYWORDS = ['специалитет', 'специалист']
 
-        cursor.execute('SELECT id, name, semester, eval_method, program_id FROM subjects WHERE semester = 0 OR eval_method = ""')
+        cursor.execute("""SELECT s.id, s.name, s.semester, s.eval_method, s.program_id, p.name
+                          FROM subjects s
+                          JOIN programs p ON p.id = s.program_id
+                          WHERE s.semester = 0 OR s.eval_method = ''""")
         rows_to_update = cursor.fetchall()
 
         if rows_to_update:
-            for sub_id, sub_name, sub_sem, sub_eval, prog_id in rows_to_update:
-                cursor.execute('SELECT name FROM programs WHERE id = ?', (prog_id,))
-                prog_name = cursor.fetchone()[0]
-
+            updates = []
+            for sub_id, sub_name, sub_sem, sub_eval, prog_id, prog_name in rows_to_update:
                 prog_type, max_semesters = determine_program_type(prog_name)
 
                 new_sem = sub_sem
@@ -833,10 +1182,10 @@ if __name__ == '__main__':
                 if not sub_eval:
                     new_eval = determine_eval_method(sub_name, new_sem, prog_type, is_practice_or_attestation)
 
-                cursor.execute('UPDATE subjects SET semester = ?, eval_method = ? WHERE id = ?', 
-                            (new_sem, new_eval, sub_id))
+                updates.append((new_sem, new_eval, sub_id))
                 print(f'Subject: {sub_name}, Semester: {new_sem}, Eval method: {new_eval}, Program: {prog_name}')
 
+            cursor.executemany('UPDATE subjects SET semester = ?, eval_method = ? WHERE id = ?', updates)
             connection_db.commit()
             print('Semesters and evaluation methods have been updated!')
         else:
@@ -869,13 +1218,12 @@ if __name__ == '__main__':
                     education_type = 'с'
                     group_count = 6
                 group_name = f"{education_type}-{make_abbr(prog_name)}"
-                for group in range(1, group_count + 1):
-                    cursor.execute('INSERT INTO groups (name, course_year, program_id) VALUES (?, ?, ?)', 
-                                (f"{group_name}-{group}", group, prog_id))
+                cursor.executemany('INSERT INTO groups (name, course_year, program_id) VALUES (?, ?, ?)',
+                                   [(f"{group_name}-{group}", group, prog_id) for group in range(1, group_count + 1)])
                 print(f'Program "{prog_name}" with {semesters} semesters: created {group_count} groups of type "{group_name}"')
-                connection_db.commit()
             else:
                 print(f'Program "{prog_name}" already has groups, skipping')
+        connection_db.commit()
         
         cursor.execute('SELECT id FROM groups ORDER BY id')
         groups = [i[0] for i in cursor.fetchall()]
@@ -889,12 +1237,14 @@ if __name__ == '__main__':
                 student_id = 200000
                 for group_id in groups:
                     student_count = random.randint(15, 25)
+                    group_students = []
                     for student in range(1, student_count + 1):
                         student_name = RussianNames().get_person()
-                        cursor.execute('INSERT INTO students (id, name, group_id) VALUES (?, ?, ?)', (student_id, student_name, group_id))
+                        group_students.append((student_id, student_name, group_id))
                         print(f'Created student {student_name} with ID {student_id} in group {group_id}')
                         student_id += 1
-                    connection_db.commit()
+                    cursor.executemany('INSERT INTO students (id, name, group_id) VALUES (?, ?, ?)', group_students)
+                connection_db.commit()
                 print('Students have been generated and saved')
             
             cursor.execute('SELECT id, group_id FROM students ORDER BY id')
@@ -906,6 +1256,9 @@ if __name__ == '__main__':
                 if cursor.fetchone()[0] != 0:
                     print('Grades table is not empty, skipping grades generation')
                 else:
+                    # cumulative weights are computed once instead of on every draw
+                    exam_cum_weights = list(accumulate(CONFIG['EXAM_PROBABILITY']))
+                    pass_cum_weights = list(accumulate(CONFIG['PASS_PROBABILITY']))
                     for student_id, group_id in students:
                         # get program and course_year for the group
                         cursor.execute('SELECT program_id, course_year FROM groups WHERE id = ?', (group_id,))
@@ -937,24 +1290,32 @@ if __name__ == '__main__':
                             print(f'Program {prog_id} has no subjects, skipping student {student_id}')
                             continue
 
+                        # draw all of the student's grades up front, one call per grading scale
+                        due_methods = [eval_method for _, semester, eval_method in subjects
+                                       if semester and semester <= student_semester]
+                        exam_count = sum(eval_method in ('Экзамен', 'Оценка') for eval_method in due_methods)
+                        pass_count = len(due_methods) - exam_count
+                        exam_grades = iter(random.choices((5, 4, 3, 2), cum_weights=exam_cum_weights, k=exam_count))
+                        # for pass/fail store 1 for pass, 0 for fail
+                        pass_grades = iter(random.choices((1, 0), cum_weights=pass_cum_weights, k=pass_count))
+
+                        student_grades = []
                         for subj_id, semester, eval_method in subjects:
                             # treat missing/zero semester as future (insert NULL)
                             if not semester or semester > student_semester:
                                 grade = None
+                            elif eval_method in ('Экзамен', 'Оценка'):
+                                grade = next(exam_grades)
                             else:
-                                if eval_method in ('Экзамен', 'Оценка'):
-                                    grade = random.choices((5, 4, 3, 2), weights=CONFIG['EXAM_PROBABILITY'])[0]
-                                else:
-                                    # for pass/fail store 1 for pass, 0 for fail
-                                    grade = random.choices((1, 0), weights=CONFIG['PASS_PROBABILITY'])[0]
-
-                            cursor.execute('INSERT INTO grades (student_id, subject_id, grade) VALUES (?, ?, ?)',
-                                           (student_id, subj_id, grade))
-                        connection_db.commit()
+                                grade = next(pass_grades)
+                            student_grades.append((student_id, subj_id, grade))
+
+                        cursor.executemany('INSERT INTO grades (student_id, subject_id, grade) VALUES (?, ?, ?)', student_grades)
                         print(f'Generated grades for student ID {student_id} (current semester: {student_semester})')
+                    connection_db.commit()
                     print('Grades have been generated and saved')
             
-            cursor.execute('SELECT id, name, group_id FROM students ORDER BY id')
+            cursor.execute('SELECT id, name, group_id FROM students ORDER BY group_id, id')
             students = cursor.fetchall()
             if not students:
                 print('No students available, cannot generate scholarships')
@@ -969,48 +1330,68 @@ if __name__ == '__main__':
                 month = now.month
                 sem_in_course = 1 if month in (9, 10, 11, 12, 1) else 2
 
+                current_group_id = None
                 for student_id, student_name, group_id in students:
-                    # get program and course_year for group
-                    cursor.execute('SELECT program_id, course_year FROM groups WHERE id = ?', (group_id,))
-                    res = cursor.fetchone()
-                    if not res:
+                    if group_id != current_group_id:
+                        # students of a group share program and semester: load the group and its grades once
+                        current_group_id = group_id
+                        cursor.execute('SELECT program_id, course_year FROM groups WHERE id = ?', (group_id,))
+                        group_res = cursor.fetchone()
+                        group_grades = defaultdict(list)
+                        if group_res and group_res[1] and group_res[1] >= 1:
+                            course_year = group_res[1]
+                            group_semester = 2 * course_year - 1 if sem_in_course == 1 else 2 * course_year
+                            # fetch grades for subjects in the current semester for all students of the group
+                            cursor.execute(
+                                '''SELECT g.student_id, g.grade
+                                   FROM grades g
+                                   JOIN subjects s ON g.subject_id = s.id
+                                   WHERE s.semester = ? AND g.student_id IN (SELECT id FROM students WHERE group_id = ?)''',
+                                (group_semester, group_id)
+                            )
+                            for grade_student_id, grade in cursor.fetchall():
+                                group_grades[grade_student_id].append(grade)
+
+                    if not group_res:
                         print(f'Group {group_id} not found for student {student_id}, skipping scholarship check')
                         continue
-                    prog_id, course_year = res
+                    prog_id, course_year = group_res
                     if not course_year or course_year < 1:
                         print(f'Invalid course_year {course_year} for group {group_id}, skipping student {student_id}')
                         continue
 
                     student_semester = 2 * course_year - 1 if sem_in_course == 1 else 2 * course_year
 
-                    # fetch grades for subjects in the current semester for this student
-                    cursor.execute(
-                        '''SELECT g.grade
-                           FROM grades g
-                           JOIN subjects s ON g.subject_id = s.id
-                           WHERE g.student_id = ? AND s.semester = ?''',
-                        (student_id, student_semester)
-                    )
-                    grade_rows = [r[0] for r in cursor.fetchall()]
+                    grade_rows = group_grades.get(student_id, [])
 
                     if not grade_rows:
                         # no grades -> scholarship = 0
                         cursor.execute('UPDATE students SET scholarship = 0 WHERE id = ?', (student_id,))
-                        connection_db.commit()
                         print(f'Student {student_name} (ID {student_id}) has no grades for semester {student_semester}, scholarship set to 0')
                         continue
 
+                    # single pass over grades: missing grades, fails and count of 4s
+                    has_missing = False
+                    has_fails = False
+                    count_fours = 0
+                    for g in grade_rows:
+                        if g is None:
+                            has_missing = True
+                            break
+                        if g in (0, 2, 3):
+                            has_fails = True
+                        elif g == 4:
+                            count_fours += 1
+
                     # if any grade is NULL (None) treat as not eligible -> scholarship = 0
-                    if any(g is None for g in grade_rows):
+                    if has_missing:
                         cursor.execute('UPDATE students SET scholarship = 0 WHERE id = ?', (student_id,))
-                        connection_db.commit()
                         print(f'Student {student_name} (ID {student_id}) has missing grades for semester {student_semester}, scholarship set to 0')
                         continue
 
                     # check for fails (0), twos (2) and threes (3) -> scholarship = 0
-                    if any(g in (0, 2, 3) for g in grade_rows):
+                    if has_fails:
                         cursor.execute('UPDATE students SET scholarship = 0 WHERE id = ?', (student_id,))
-                        connection_db.commit()
                         print(f'Student {student_name} (ID {student_id}) is NOT eligible (has 0,2 or 3) for semester {student_semester}, scholarship set to 0')
                         continue
 
@@ -1022,12 +1403,10 @@ if __name__ == '__main__':
                         awarded_social += social_amt
                         student_awarded_total += social_amt
                         cursor.execute('UPDATE students SET scholarship = ? WHERE id = ?', (student_awarded_total, student_id))
-                        connection_db.commit()
                         print(f'Awarded social scholarship {social_amt} to {student_name} (ID {student_id})')
                     else:
                         # either insufficient funds or chance failed -> no social scholarship
                         cursor.execute('UPDATE students SET scholarship = 0 WHERE id = ?', (student_id,))
-                        connection_db.commit()
                         if remaining < social_amt:
                             print(f'Insufficient funds for social scholarship for {student_name} (ID {student_id}), remaining {remaining}')
                         else:
@@ -1035,7 +1414,6 @@ if __name__ == '__main__':
                         continue  # cannot award academic if social wasn't given
 
                     # check academic chance: at most two 4s
-                    count_fours = sum(1 for g in grade_rows if g == 4)
                     if count_fours <= 2:
                         if random.random() < academic_prob:
                             if remaining >= academic_amt:
@@ -1043,7 +1421,6 @@ if __name__ == '__main__':
                                 awarded_academic += academic_amt
                                 student_awarded_total += academic_amt
                                 cursor.execute('UPDATE students SET scholarship = ? WHERE id = ?', (student_awarded_total, student_id))
-                                connection_db.commit()
                                 print(f'Also awarded ACADEMIC scholarship {academic_amt} to {student_name} (ID {student_id})')
                             else:
                                 print(f'Insufficient funds for academic scholarship for {student_name} (ID {student_id}), remaining {remaining}')
@@ -1052,6 +1429,7 @@ if __name__ == '__main__':
                     else:
                         print(f'{student_name} (ID {student_id}) has more than two 4s ({count_fours}), not eligible for academic scholarship')
 
+                connection_db.commit()
                 print('Scholarship distribution finished.')
                 print(f'Total social awarded: {awarded_social}, total academic awarded: {awarded_academic}')
                 print(f'Remaining scholarship fund: {remaining}')